@@ -27,6 +27,7 @@ REGION = 'us-east-1'  # Change to your preferred region
 CLUSTER_NAME = 'PySpark-IDE-Cluster'
 RELEASE_LABEL = 'emr-6.4.0'  # EMR release with Spark 3.1.1 and JupyterHub
 INSTANCE_TYPE = 'm5.xlarge'  # Master and core instances
+INSTANCE_VCPUS = 4  # vCPUs per INSTANCE_TYPE node
 INSTANCE_COUNT = 3  # 1 master + 2 core nodes
 KEY_NAME = None  # Optional: your EC2 key pair name for SSH access
 SUBNET_ID = None  # Optional: specify if in VPC
@@ -39,6 +40,20 @@ APPLICATIONS = [
     {'Name': 'Hadoop'}  # Required for HDFS
 ]
 
+# Spark tunings applied cluster-wide via spark-defaults (the lab script sets the same
+# values on its local session); shuffle partitions are sized to 2x the core-node vCPUs
+SPARK_DEFAULTS = {
+    'Classification': 'spark-defaults',
+    'Properties': {
+        'spark.sql.shuffle.partitions': str(2 * INSTANCE_VCPUS * (INSTANCE_COUNT - 1)),
+        'spark.sql.autoBroadcastJoinThreshold': '8192',
+        'spark.sql.inMemoryColumnarStorage.batchSize': '20000',
+        'spark.sql.codegen.maxFields': '200',
+        'spark.shuffle.compress': 'true',
+        'spark.shuffle.file.buffer': '64k',
+    },
+}
+
 # Instance groups
 INSTANCE_GROUPS = [
     {
@@ -65,6 +80,7 @@ def create_emr_cluster():
             'Name': CLUSTER_NAME,
             'ReleaseLabel': RELEASE_LABEL,
             'Applications': APPLICATIONS,
+            'Configurations': [SPARK_DEFAULTS],
             'Instances': {
                 'InstanceGroups': INSTANCE_GROUPS,
                 'KeepJobFlowAliveWhenNoSteps': True,  # Keep cluster alive after steps complete
@@ -1,99 +1,155 @@
 import argparse
+import os
 import re
-from collections import Counter
+import string
+from urllib.parse import unquote
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
 from pyspark.sql.functions import col
-from pymongo import MongoClient
+from pyspark.sql.types import ArrayType, StringType
+from pymongo import InsertOne, MongoClient
 
-STOPWORDS = {"is","a","the","to","with","and"}
+STOPWORDS = frozenset({"is","a","the","to","with","and"})
 
 WORD_RE = re.compile(r"\b[0-9a-zA-Z']+\b")
+# WORD_RE.pattern escaped for use inside a Spark SQL string literal
+WORD_RE_SQL = WORD_RE.pattern.replace('\\', '\\\\').replace("'", "\\'")
+
+
+# translation table mapping every Latin-1 character outside the word alphabet to a space
+_KEEP = set(string.ascii_letters + string.digits + "'")
+_TRANS = str.maketrans({chr(i): ' ' for i in range(256) if chr(i) not in _KEEP})
 
 
 def tokenize(text):
-    return [w.lower() for w in WORD_RE.findall(text)]
+    # ASCII text without '_': a C-level translate + split, much faster than WORD_RE.findall.
+    # Stripping edge apostrophes (and dropping quote-only pieces) then gives WORD_RE's words.
+    if text.isascii() and '_' not in text:
+        return [w for w in (t.strip("'") for t in text.translate(_TRANS).lower().split()) if w]
+    # '_' and non-ASCII letters are word characters for \b, which the table cannot express, so use the regex
+    return WORD_RE.findall(text.lower())
+
+
+def split_words(column):
+    # WORD_RE's matches as a Spark SQL array column, extracted in the JVM
+    return F.expr(f"regexp_extract_all(lower({column}), '{WORD_RE_SQL}', 0)")
 
 
 def rdd_word_counts(spark, path):
-    sc = spark.sparkContext
-    lines = sc.textFile(path)
-    words = lines.flatMap(lambda l: tokenize(l))
-    counts = words.map(lambda w: (w,1)).reduceByKey(lambda a,b: a+b)
+    # tokenize with native Spark SQL functions so lines never leave the JVM
+    words = spark.read.text(path).select(F.explode(split_words('value')).alias('word'))
+    counts = words.groupBy('word').count()
     return counts
 
 
-def compare_stopwords(counts_rdd):
+def total_count(df):
+    return df.agg(F.sum('count').alias('t')).first()[0]
+
+
+def compare_stopwords(counts_df):
+    # one sorted pass deep enough that 10 words survive even if every stopword ranks above them
+    top = counts_df.orderBy(F.desc('count')).limit(10 + len(STOPWORDS)).collect()
     # top 10 before
-    total = counts_rdd.map(lambda x: x[1]).sum()
-    top_before = counts_rdd.takeOrdered(10, key=lambda x: -x[1])
+    top_before = top[:10]
     # remove stopwords
-    filtered = counts_rdd.filter(lambda x: x[0] not in STOPWORDS)
-    top_after = filtered.takeOrdered(10, key=lambda x: -x[1])
-    return total, top_before, top_after, filtered
+    filtered = counts_df.where(~col('word').isin(*STOPWORDS))
+    top_after = [r for r in top if r['word'] not in STOPWORDS][:10]
+    return top_before, top_after, filtered
 
 
-def df_from_counts(spark, counts_rdd):
-    df = counts_rdd.toDF(["word","count"]).withColumn("length", col("word").rlike(".").cast("int")*0+1)
-    # compute accurate length
-    df = df.rdd.map(lambda r: (r['word'], r['count'], len(r['word']))).toDF(["word","count","length"])
-    total = df.groupBy().sum('count').collect()[0][0]
-    df = df.withColumn('freq', col('count')/total)
-    return df, total
+def df_from_counts(spark, counts_df, total):
+    df = counts_df.withColumn('length', F.length('word'))
+    df = df.withColumn('freq', col('count')/F.lit(total))
+    return df
 
 
 def weighted_avg_word_length(df, total):
     # sum(length * count)/total
-    s = df.rdd.map(lambda r: r['length']*r['count']).sum()
+    s = df.agg(F.sum(col('length')*col('count'))).first()[0]
     return s/total
 
 
 def ten_longest(df):
-    return df.orderBy(col('length').desc()).limit(10).select('word','count','length').collect()
+    # project before the sort so orderBy+limit plans as a single TakeOrderedAndProject
+    return df.select('word','count','length').orderBy(F.desc('length')).limit(10).collect()
 
 
-def filter_count_ge(df, n):
-    total = df.groupBy().sum('count').collect()[0][0]
+def filter_count_ge(df, n, total):
     filtered = df.filter(col('count') >= n)
-    share = filtered.groupBy().sum('count').collect()[0][0] / total
+    share = total_count(filtered) / total
     return filtered, share
 
 
-def mongo_store_counts(counts_rdd, mongo_uri, db_name='spark_text_lab', coll_name='words'):
+MONGO_BATCH_SIZE = 1000
+# serves query_mongo_by_length: sort key before the range key, so count order comes from the index
+COUNT_LENGTH_INDEX = [('count', -1), ('length', 1)]
+
+
+def mongo_partition_writer(mongo_uri, db_name, coll_name, batch_size=MONGO_BATCH_SIZE):
+    # runs on the executors: one client per partition, unordered bulk writes.
+    # Writes are acknowledged (w=1) so failures surface and the driver can read the data back right after.
+    def write(docs):
+        with MongoClient(mongo_uri, w=1) as client:
+            coll = client[db_name][coll_name]
+            ops = []
+            for doc in docs:
+                ops.append(InsertOne(doc))
+                if len(ops) >= batch_size:
+                    coll.bulk_write(ops, ordered=False)
+                    ops = []
+            if ops:
+                coll.bulk_write(ops, ordered=False)
+    return write
+
+
+def mongo_write_docs(docs, mongo_uri, db_name, coll_name):
+    # each partition opens its own client, so cap at ~2 partitions per core rather than one per shuffle partition
+    docs = docs.coalesce(2 * docs.context.defaultParallelism)
+    docs.foreachPartition(mongo_partition_writer(mongo_uri, db_name, coll_name))
+
+
+def mongo_store_counts(counts_df, mongo_uri, db_name='spark_text_lab', coll_name='words'):
     client = MongoClient(mongo_uri)
     db = client[db_name]
     coll = db[coll_name]
-    # replace collection
+    # replace collection; dropping also removes any indexes so the load runs index-free
     coll.drop()
-    docs = counts_rdd.map(lambda wc: {'word': wc[0], 'count': int(wc[1]), 'length': len(wc[0])}).collect()
-    if docs:
-        coll.insert_many(docs)
-        coll.create_index([('count', -1)])
+    docs = counts_df.rdd.map(lambda wc: {'word': wc[0], 'count': int(wc[1]), 'length': len(wc[0])})
+    mongo_write_docs(docs, mongo_uri, db_name, coll_name)
+    # build indexes once the load is done instead of maintaining them per insert
+    coll.create_index([('count', -1)], background=True)
+    coll.create_index([('word', 1)], background=True)
+    coll.create_index(COUNT_LENGTH_INDEX, background=True)
     return coll
 
 
 def query_mongo_by_length(mongo_uri, min_length=7, db_name='spark_text_lab', coll_name='words'):
     client = MongoClient(mongo_uri)
     coll = client[db_name][coll_name]
-    return list(coll.find({'length': {'$gte': min_length}}).sort('count', -1))
+    cursor = coll.find({'length': {'$gte': min_length}}, {'word': 1, 'count': 1, '_id': 0})
+    return list(cursor.sort('count', -1).batch_size(MONGO_BATCH_SIZE))
 
 
 def top_bigrams(spark, path, top_k=20):
-    sc = spark.sparkContext
-    lines = sc.textFile(path)
-    tokens = lines.map(lambda l: tokenize(l)).filter(lambda t: t)
-    bigrams = tokens.flatMap(lambda ws: [ (ws[i]+" "+ws[i+1],1) for i in range(len(ws)-1)])
-    bigram_counts = bigrams.reduceByKey(lambda a,b: a+b)
-    return bigram_counts.takeOrdered(top_k, key=lambda x:-x[1])
+    lines = spark.read.text(path)
+    tokens = lines.select(split_words('value').alias('ws')).where(F.size('ws') > 1)
+    # pair each token with its successor by zipping the array against itself shifted by one
+    pairs = tokens.select(F.explode(F.arrays_zip(F.expr('slice(ws, 1, size(ws)-1)'), F.expr('slice(ws, 2, size(ws))'))).alias('p')).select('p.*')
+    bigrams = pairs.select(F.concat_ws(' ', *pairs.columns).alias('bigram'))
+    return bigrams.groupBy('bigram').count().orderBy(F.desc('count')).limit(top_k).collect()
 
 
 def compute_tfidf(spark, path):
     from pyspark.sql.functions import monotonically_increasing_id
-    from pyspark.ml.feature import Tokenizer, HashingTF, IDF
+    from pyspark.ml.feature import RegexTokenizer, HashingTF, IDF
     docs = spark.read.text(path).toDF('text')
     docs = docs.withColumn('id', monotonically_increasing_id())
-    tokenizer = Tokenizer(inputCol='text', outputCol='words')
+    # same word definition as the other exercises, so "word," and "word" hash to one feature
+    tokenizer = RegexTokenizer(inputCol='text', outputCol='words', pattern=WORD_RE.pattern, gaps=False, toLowercase=True, minTokenLength=1)
     wordsData = tokenizer.transform(docs)
     hashingTF = HashingTF(inputCol='words', outputCol='rawFeatures', numFeatures=1<<12)
+    # not cached: IDF.fit is the only full pass, and the lazy result only hashes the rows a caller takes
     featurizedData = hashingTF.transform(wordsData)
     idf = IDF(inputCol='rawFeatures', outputCol='features')
     idfModel = idf.fit(featurizedData)
@@ -102,34 +158,40 @@ def compute_tfidf(spark, path):
 
 
 def per_file_and_global_counts(spark, folder):
-    sc = spark.sparkContext
-    # wholeTextFiles returns (path, content)
-    files = sc.wholeTextFiles(folder)
-    per_file = files.mapValues(lambda text: Counter(tokenize(text))).map(lambda kv: (kv[0].split('/')[-1], dict(kv[1])))
-    # global
-    global_counts = files.flatMap(lambda kv: tokenize(kv[1])).map(lambda w: (w,1)).reduceByKey(lambda a,b: a+b)
-    # top 20 keywords per file
-    top_per_file = files.mapValues(lambda text: Counter(tokenize(text)).most_common(20)).collect()
-    return per_file.collect(), global_counts
-
-
-def store_global_and_perfile_mongo(per_file, global_counts_rdd, mongo_uri, db_name='spark_text_lab'):
+    # pandas/pyarrow are only needed for this exercise, so the UDF is built here
+    import pandas as pd
+    from pyspark.sql.functions import pandas_udf
+
+    @pandas_udf(ArrayType(StringType()))
+    def tokenize_udf(texts: pd.Series) -> pd.Series:
+        # Arrow-batched: one call per batch of rows instead of one pickle per row
+        return texts.map(tokenize)
+
+    # one row per file, read in the JVM; the file name comes from the (URI-encoded) input path
+    files = spark.read.text(folder, wholetext=True).withColumn('file', F.element_at(F.split(F.input_file_name(), '/'), -1))
+    words = files.select('file', F.explode(tokenize_udf('value')).alias('word'))
+    # tokenize each file exactly once; every output below is derived from these counts.
+    # Left cached for the caller, which writes it out and unpersists it.
+    per_file = words.groupBy('file', 'word').count().persist(StorageLevel.MEMORY_AND_DISK)
+    # global: the per-file counts are already aggregated, so only distinct words per file are shuffled
+    global_counts = per_file.groupBy('word').agg(F.sum('count').alias('count'))
+    return per_file, global_counts
+
+
+def store_global_and_perfile_mongo(per_file_df, global_counts_df, mongo_uri, db_name='spark_text_lab'):
     client = MongoClient(mongo_uri)
     db = client[db_name]
     db.global_wordcount.drop()
     db.per_file_wordcount.drop()
     # insert global
-    docs = global_counts_rdd.map(lambda wc: {'word': wc[0], 'count': int(wc[1])}).collect()
-    if docs:
-        db.global_wordcount.insert_many(docs)
-        db.global_wordcount.create_index([('count', -1)])
+    docs = global_counts_df.rdd.map(lambda wc: {'word': wc[0], 'count': int(wc[1])})
+    mongo_write_docs(docs, mongo_uri, db_name, 'global_wordcount')
+    db.global_wordcount.create_index([('count', -1)], background=True)
+    db.global_wordcount.create_index([('word', 1)], background=True)
     # per-file
-    per_docs = []
-    for fname, d in per_file:
-        for w,c in d.items():
-            per_docs.append({'file': fname, 'word': w, 'count': int(c)})
-    if per_docs:
-        db.per_file_wordcount.insert_many(per_docs)
+    per_docs = per_file_df.rdd.map(lambda r: {'file': unquote(r['file']), 'word': r['word'], 'count': int(r['count'])})
+    mongo_write_docs(per_docs, mongo_uri, db_name, 'per_file_wordcount')
+    db.per_file_wordcount.create_index([('file', 1), ('count', -1)], background=True)
     return True
 
 
@@ -140,17 +202,30 @@ def main():
     parser.add_argument('--folder', default=None, help='folder for exercise 6')
     args = parser.parse_args()
 
-    spark = SparkSession.builder.master('local[*]').appName('SparkTextLab').getOrCreate()
-
-    counts = rdd_word_counts(spark, args.corpus)
-    total, top_before, top_after, filtered = compare_stopwords(counts)
+    # local[*] runs one task per core; the default 200 shuffle partitions would mostly be empty.
+    # On EMR these belong in the cluster's spark-defaults instead (see SPARK_DEFAULTS in setup_emr.py).
+    num_cores = os.cpu_count() or 1
+    spark = SparkSession.builder.master('local[*]').appName('SparkTextLab') \
+        .config('spark.sql.shuffle.partitions', str(2 * num_cores)) \
+        .config('spark.sql.autoBroadcastJoinThreshold', '8192') \
+        .config('spark.sql.inMemoryColumnarStorage.batchSize', '20000') \
+        .config('spark.sql.codegen.maxFields', '200') \
+        .config('spark.shuffle.compress', 'true') \
+        .config('spark.shuffle.file.buffer', '64k') \
+        .config('spark.sql.execution.arrow.pyspark.enabled', 'true') \
+        .getOrCreate()
+
+    # counts feeds every exercise below; cache it so the corpus is read and tokenized once
+    counts = rdd_word_counts(spark, args.corpus).persist(StorageLevel.MEMORY_AND_DISK)
+    total = total_count(counts)
+    top_before, top_after, filtered = compare_stopwords(counts)
     print('Top 10 before stopword removal:', top_before)
     print('Top 10 after stopword removal:', top_after)
 
-    df, total_count = df_from_counts(spark, counts)
-    print('Weighted avg word length:', weighted_avg_word_length(df, total_count))
+    df = df_from_counts(spark, counts, total)
+    print('Weighted avg word length:', weighted_avg_word_length(df, total))
     print('10 longest words:', ten_longest(df))
-    filtered_df, share = filter_count_ge(df, 2)
+    filtered_df, share = filter_count_ge(df, 2, total)
     print('Share of total frequency for count>=2:', share)
 
     if args.mongo_uri:
@@ -169,8 +244,10 @@ def main():
     if args.folder and args.mongo_uri:
         per_file, global_counts = per_file_and_global_counts(spark, args.folder)
         store_global_and_perfile_mongo(per_file, global_counts, args.mongo_uri)
+        per_file.unpersist()
         print('Per-file and global counts stored in MongoDB')
 
+    counts.unpersist()
     spark.stop()
 
 if __name__ == '__main__':